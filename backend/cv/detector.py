@@ -1,27 +1,105 @@
 import os
-from typing import List, Tuple
+import threading
+from typing import List, Optional, Tuple
 
 import cv2
 
 
-def _resolve_cascade_path() -> str:
+# Detector name -> cascade file. LBP is faster but frames faces differently from Haar,
+# so models trained with one don't match crops from the other; Haar is the default.
+_CASCADE_FILES = {
+    "lbp": "lbpcascade_frontalface_improved.xml",
+    "haar": "haarcascade_frontalface_default.xml",
+}
+DEFAULT_DETECTOR = "haar"
+
+
+def _resolve_cascade_path(detector: str = "haar") -> Optional[str]:
+    filename = _CASCADE_FILES[detector]
     # Prefer bundled file if present; otherwise fallback to OpenCV's data path
-    local_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "haarcascade_frontalface_default.xml")
+    local_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), filename)
     if os.path.exists(local_path):
         return local_path
-    opencv_path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
-    return opencv_path
+    if detector == "haar":
+        return os.path.join(cv2.data.haarcascades, filename)
+    # Full OpenCV installs keep lbpcascades/ next to haarcascades/; pip wheels don't ship it
+    opencv_path = os.path.join(os.path.dirname(os.path.normpath(cv2.data.haarcascades)), "lbpcascades", filename)
+    return opencv_path if os.path.exists(opencv_path) else None
 
 
-_CASCADE_PATH = _resolve_cascade_path()
-_face_cascade = cv2.CascadeClassifier(_CASCADE_PATH)
+def _load_cascade(path: Optional[str]) -> cv2.CascadeClassifier:
+    # A missing file gives an empty classifier (detectMultiScale would then fail on every
+    # frame) and a malformed one raises; report both the same way
+    try:
+        cascade = cv2.CascadeClassifier(path) if path else None
+    except Exception:
+        cascade = None
+    if cascade is None or cascade.empty():
+        raise RuntimeError(f"Could not load face detection cascade: {path}")
+    return cascade
 
 
-def detect_faces(gray_image) -> List[Tuple[int, int, int, int]]:
-    # Slightly stricter detector to reduce false positives
-    faces = _face_cascade.detectMultiScale(gray_image, scaleFactor=1.1, minNeighbors=7, minSize=(100, 100))
-    return [(int(x), int(y), int(w), int(h)) for (x, y, w, h) in faces]
+# detectMultiScale reuses scratch buffers inside the classifier, so each thread keeps
+# its own copy (cached with the path it was loaded from)
+_thread_state = threading.local()
+
+
+def _use_cascade(path: Optional[str]) -> None:
+    global _CASCADE_PATH
+    _thread_state.cascade = _load_cascade(path)
+    _thread_state.path = _CASCADE_PATH = path
+
 
+# Load at import so a broken install fails at startup rather than on the first frame
+_CASCADE_PATH: Optional[str] = None
+_use_cascade(_resolve_cascade_path(DEFAULT_DETECTOR))
 
 
+def set_detector(detector: str) -> str:
+    """Select the cascade used by detect_faces ("lbp" or "haar"). Falls back to Haar
+    when the name is unknown or its file is missing or unreadable; returns the
+    detector in use.
+    """
+    if detector in _CASCADE_FILES and detector != "haar":
+        try:
+            _use_cascade(_resolve_cascade_path(detector))
+            return detector
+        except RuntimeError:
+            pass
+    _use_cascade(_resolve_cascade_path("haar"))
+    return "haar"
 
+
+def _get_cascade() -> cv2.CascadeClassifier:
+    cascade = getattr(_thread_state, "cascade", None)
+    if cascade is None or _thread_state.path != _CASCADE_PATH:
+        cascade = _load_cascade(_CASCADE_PATH)
+        _thread_state.cascade = cascade
+        _thread_state.path = _CASCADE_PATH
+    return cascade
+
+
+# Longest image side the cascade runs on; larger frames are downscaled first
+DETECT_MAX_SIDE = 512
+_MIN_FACE_SIZE = 100
+# Smallest size the minimum face may shrink to. The cascade's window is 24 px, and
+# faces near that size in the downscaled copy are missed, so the downscale stops
+# here even when the frame is still larger than DETECT_MAX_SIDE
+_MIN_SCALED_FACE = 48
+
+
+def detect_faces(gray_image, image_size: Optional[Tuple[int, int]] = None) -> List[Tuple[int, int, int, int]]:
+    # gray_image may be a cv2.UMat (OpenCL); it has no .shape, so pass its
+    # (height, width) as image_size.
+    # Run the cascade on a downscaled copy (its cost grows with pixel count) and
+    # map the boxes back to full-resolution coordinates
+    h, w = image_size if image_size is not None else gray_image.shape[:2]
+    scale = max(1.0, min(max(h, w) / float(DETECT_MAX_SIDE), _MIN_FACE_SIZE / float(_MIN_SCALED_FACE)))
+    if scale > 1.0:
+        small = cv2.resize(gray_image, (int(w / scale), int(h / scale)), interpolation=cv2.INTER_AREA)
+    else:
+        small = gray_image
+    min_side = max(1, int(_MIN_FACE_SIZE / scale))
+    # Slightly stricter detector to reduce false positives
+    faces = _get_cascade().detectMultiScale(small, scaleFactor=1.1, minNeighbors=7, minSize=(min_side, min_side))
+    return [(int(x * scale), int(y * scale), int(bw * scale), int(bh * scale)) for (x, y, bw, bh) in faces]
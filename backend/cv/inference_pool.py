@@ -0,0 +1,71 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+
+class InferencePoolBusyError(RuntimeError):
+    """Too many calls are already waiting for the inference pool."""
+
+
+class InferencePool:
+    """Runs a blocking `handler(item)` on a dedicated thread pool, dispatching each call
+    as soon as it is submitted. Decode, detection and LBP release the GIL, so frames from
+    several clients overlap instead of queueing behind the event loop, and a slow call
+    (e.g. a large photo) only occupies its own worker.
+
+    At most `max_pending` calls are handed to the pool at once; further callers wait
+    their turn on a semaphore. Once `max_waiting` callers are waiting, submit raises
+    InferencePoolBusyError instead of queueing more.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Any],
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        max_waiting: Optional[int] = None,
+    ) -> None:
+        self._handler = handler
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._max_pending = max_pending or 2 * self._max_workers
+        self._max_waiting = max_waiting or 2 * self._max_pending
+        self._waiting = 0
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(
+        self, item: Any, is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+    ) -> Any:
+        """Run `handler(item)` on the pool and return its result. If `is_disconnected`
+        reports True once a slot is free, the caller is gone: returns None without
+        running the handler.
+        """
+        loop = asyncio.get_running_loop()
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="infer")
+        if self._loop is not loop:
+            # The semaphore belongs to one event loop; make a new one if the app restarted
+            self._slots = asyncio.Semaphore(self._max_pending)
+            self._loop = loop
+            self._waiting = 0
+        assert self._slots is not None
+        if self._slots.locked() and self._waiting >= self._max_waiting:
+            raise InferencePoolBusyError("Too many inference requests. Please retry shortly.")
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            if is_disconnected is not None and await is_disconnected():
+                return None
+            return await loop.run_in_executor(self._pool, self._handler, item)
+        finally:
+            self._slots.release()
+
+    async def stop(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -1,25 +1,115 @@
-import base64
+import binascii
+import contextlib
 import io
+import json
+import mmap
 import os
-from typing import Optional, Tuple
+from typing import Any, BinaryIO, Iterator, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 
+try:
+    import orjson
+except ImportError:  # Optional speedup; stdlib json produces the same files
+    orjson = None
+
 
 def ensure_dir(path: str) -> None:
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
 
 
-def decode_data_url_to_image(data_url: str) -> Optional[np.ndarray]:
-    if not isinstance(data_url, str) or "," not in data_url:
+# Largest base64 payload accepted from a data URL (about 12 MB of image bytes)
+MAX_DATA_URL_PAYLOAD = 16 * 1024 * 1024
+
+
+def write_json_atomic(path: str, obj: Any) -> None:
+    """Write `obj` as indented JSON to a temp file, fsync it, then os.replace it over
+    `path`, so a crash never leaves a half-written file behind.
+    """
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(obj, indent=2).encode("utf-8")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str) -> Any:
+    """Parse the JSON file at `path` (with orjson when available)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def save_array_atomic(path: str, array: np.ndarray) -> None:
+    """np.save `array` to `path` through a temp file and os.replace, so readers never
+    see a partial file. Not fsynced: callers use this for data they can regenerate.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def file_buffer(fileobj: BinaryIO) -> Iterator[Union[bytes, memoryview, mmap.mmap]]:
+    """Yield the whole contents of a binary file object, without copying when possible:
+    a view of an in-memory buffer (BytesIO, or a SpooledTemporaryFile that has not
+    rolled over to disk) or a read-only mmap of a real file. Anything else is read.
+    """
+    # SpooledTemporaryFile keeps its BytesIO / temp file in _file
+    raw = getattr(fileobj, "_file", fileobj)
+    if isinstance(raw, io.BytesIO):
+        view = raw.getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+    try:
+        raw.flush()
+        mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        # No file descriptor, or an empty file (which can't be mapped)
+        fileobj.seek(0)
+        yield fileobj.read()
+        return
+    try:
+        yield mapped
+    finally:
+        mapped.close()
+
+
+def decode_image(
+    source: Union[str, bytes, bytearray, memoryview, mmap.mmap], flags: int = cv2.IMREAD_COLOR
+) -> Optional[np.ndarray]:
+    """Decode encoded image bytes, or a base64 data URL when given a str. Pass
+    flags=cv2.IMREAD_GRAYSCALE to decode straight to one channel.
+    """
+    if isinstance(source, str):
+        comma = source.find(",")
+        if comma < 0 or len(source) - comma - 1 > MAX_DATA_URL_PAYLOAD:
+            return None
+        try:
+            # Decode from a view past the header instead of splitting off a copy of the payload
+            payload = memoryview(source.encode("ascii"))[comma + 1:]
+            img_bytes = binascii.a2b_base64(payload)
+        except Exception:
+            return None
+    elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        # Raw bytes (e.g. a multipart upload) need no base64 step and are not copied
+        img_bytes = source
+    else:
         return None
     try:
-        header, b64data = data_url.split(",", 1)
-        img_bytes = base64.b64decode(b64data)
         img_array = np.frombuffer(img_bytes, dtype=np.uint8)
-        image = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        image = cv2.imdecode(img_array, flags)
         return image
     except Exception:
         return None
@@ -40,8 +130,9 @@ def crop_to_bbox(image: np.ndarray, bbox: Tuple[int, int, int, int]) -> np.ndarr
 
 
 def resize_image(image: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
-    return cv2.resize(image, size)
-
-
-
-
+    # Box filter when shrinking both sides (faster and alias-free), bilinear otherwise
+    if size[0] < image.shape[1] and size[1] < image.shape[0]:
+        interp = cv2.INTER_AREA
+    else:
+        interp = cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation=interp)
@@ -0,0 +1,317 @@
+import copy
+import functools
+import os
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+# Rows compared per step; bounds the temporaries for wide LBPH histograms
+_BLOCK_ROWS = 64
+
+
+def chi_square(hists: np.ndarray, query: np.ndarray, hist_sums: Optional[np.ndarray] = None) -> np.ndarray:
+    """Chi-square distance of `query` to every row of `hists`, matching OpenCV's
+    HISTCMP_CHISQR_ALT (the metric LBPHFaceRecognizer.predict uses).
+
+    Uses (a - b)^2 / (a + b) == a + b - 4ab / (a + b): the last term is zero wherever
+    the query bin is empty, so only the query's non-empty bins are visited. Pass
+    `hist_sums` (row sums of `hists`) to skip recomputing them per query. `hists` may
+    be stored compactly (e.g. uint16 counts); each gathered block is widened to float32.
+    """
+    hists = np.asarray(hists)
+    query = np.asarray(query, dtype=np.float32).ravel()
+    if hist_sums is None:
+        hist_sums = hists.sum(axis=1, dtype=np.float64)
+    nz = np.flatnonzero(query)
+    q = query[nz]
+    cross = np.empty(hists.shape[0], dtype=np.float64)
+    for start in range(0, hists.shape[0], _BLOCK_ROWS):
+        block = np.asarray(hists[start:start + _BLOCK_ROWS, nz], dtype=np.float32)
+        cross[start:start + block.shape[0]] = (block * q / (block + q)).sum(axis=1, dtype=np.float64)
+    out = hist_sums + float(q.sum(dtype=np.float64)) - 4.0 * cross
+    # Guard against tiny negatives from rounding on near-identical histograms
+    np.maximum(out, 0.0, out=out)
+    out *= 2.0
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def _sampling_table(radius: int, neighbors: int) -> Tuple[Tuple[int, int, int, int, Tuple[float, ...]], ...]:
+    """Per-neighbor (fy, fx, cy, cx, weights) for the circular sampling pattern, with
+    float32 weights computed exactly as OpenCV does.
+    """
+    table = []
+    for n in range(neighbors):
+        x = np.float32(radius * np.cos(2.0 * np.pi * n / neighbors))
+        y = np.float32(-radius * np.sin(2.0 * np.pi * n / neighbors))
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        tx, ty = x - np.float32(fx), y - np.float32(fy)
+        weights = ((1 - tx) * (1 - ty), tx * (1 - ty), (1 - tx) * ty, tx * ty)
+        table.append((fy, fx, cy, cx, weights))
+    return tuple(table)
+
+
+def lbp_codes(gray: np.ndarray, radius: int, neighbors: int) -> np.ndarray:
+    """Extended (circular) LBP codes with bilinear sampling, following OpenCV's
+    LBPHFaceRecognizer. The result is (rows - 2*radius, cols - 2*radius) int32.
+    """
+    src = np.asarray(gray, dtype=np.uint8)
+    rows, cols = src.shape[:2]
+    out_rows, out_cols = rows - 2 * radius, cols - 2 * radius
+
+    def shifted(dy: int, dx: int) -> np.ndarray:
+        return src[radius + dy:radius + dy + out_rows, radius + dx:radius + dx + out_cols]
+
+    center = shifted(0, 0)
+    center_f = center.astype(np.float32)
+    codes = np.zeros((out_rows, out_cols), dtype=np.int32)
+    t = np.empty((out_rows, out_cols), dtype=np.float32)
+    tmp = np.empty_like(t)
+    bit = np.empty((out_rows, out_cols), dtype=bool)
+    # OpenCV sets the bit when t > c or |t - c| < eps, which is exactly t - c > -eps
+    neg_eps = -np.finfo(np.float32).eps
+    for n, (fy, fx, cy, cx, (w1, w2, w3, w4)) in enumerate(_sampling_table(radius, neighbors)):
+        if w1 == 1.0:
+            # Axis-aligned sample: the other weights are ~1e-16 and vanish in float32,
+            # so the interpolated value is the pixel itself
+            np.greater_equal(shifted(fy, fx), center, out=bit)
+        else:
+            np.multiply(shifted(fy, fx), w1, out=t)
+            for w, (dy, dx) in ((w2, (fy, cx)), (w3, (cy, fx)), (w4, (cy, cx))):
+                np.multiply(shifted(dy, dx), w, out=tmp)
+                t += tmp
+            t -= center_f
+            np.greater(t, neg_eps, out=bit)
+        codes |= bit.view(np.uint8).astype(np.int32) << n
+    return codes
+
+
+@functools.lru_cache(maxsize=8)
+def _cell_offsets(height: int, width: int, grid_x: int, grid_y: int, num_patterns: int) -> np.ndarray:
+    """(grid_y*height, grid_x*width) map adding `cell_index * num_patterns` to each code,
+    so one bincount fills every cell histogram at once.
+    """
+    rows = np.repeat(np.arange(grid_y), height)[:, None]
+    cols = np.repeat(np.arange(grid_x), width)[None, :]
+    offsets = ((rows * grid_x + cols) * num_patterns).astype(np.intp)
+    offsets.flags.writeable = False
+    return offsets
+
+
+def cell_area(rows: int, cols: int, radius: int, grid_x: int, grid_y: int) -> int:
+    """Pixels per histogram cell for a rows x cols face crop."""
+    return ((rows - 2 * radius) // grid_y) * ((cols - 2 * radius) // grid_x)
+
+
+def spatial_histogram(codes: np.ndarray, num_patterns: int, grid_x: int, grid_y: int, normed: bool = True) -> np.ndarray:
+    """Concatenated per-cell histograms of `codes`, each normalized by the cell size.
+    With normed=False the raw per-cell counts are returned as uint16.
+    """
+    height = codes.shape[0] // grid_y
+    width = codes.shape[1] // grid_x
+    offsets = _cell_offsets(height, width, grid_x, grid_y, num_patterns)
+    # Rows/cols past the last full cell are dropped, as in OpenCV
+    binned = offsets + codes[:grid_y * height, :grid_x * width]
+    counts = np.bincount(binned.ravel(), minlength=grid_x * grid_y * num_patterns)
+    if not normed:
+        return counts.astype(np.uint16)
+    hist = counts.astype(np.float32)
+    hist *= np.float32(1.0 / (height * width))
+    return hist
+
+
+def lbp_histogram(
+    gray: np.ndarray, radius: int, neighbors: int, grid_x: int, grid_y: int, normed: bool = True
+) -> np.ndarray:
+    """LBPH feature vector of a face crop, comparable with getHistograms() rows
+    (or, with normed=False, those rows multiplied by the cell area).
+    """
+    codes = lbp_codes(gray, radius, neighbors)
+    return spatial_histogram(codes, 2 ** neighbors, grid_x, grid_y, normed)
+
+
+def _to_sparse(hists: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(non-zeros per row, column indices, values) of a 2-D count matrix, row by row."""
+    mask = hists != 0
+    flat = np.flatnonzero(mask)
+    return mask.sum(axis=1, dtype=np.int64), (flat % hists.shape[1]).astype(np.int32), hists.ravel()[flat]
+
+
+class LBPHModel:
+    """LBPH face model over the functions above: per-sample histograms plus labels.
+
+    Histograms are kept as uint16 per-cell counts (each OpenCV bin is a count divided
+    by the cell area, so nothing is lost) and distances are reported on the scale of
+    LBPHFaceRecognizer.predict, so thresholds tuned for OpenCV still apply.
+    """
+
+    def __init__(self, radius: int, neighbors: int, grid_x: int, grid_y: int, face_size: Tuple[int, int]) -> None:
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        # (width, height) of the faces this model is trained on and queried with
+        self.face_size = face_size
+        self.cell_area = cell_area(face_size[1], face_size[0], radius, grid_x, grid_y)
+        self._clear()
+
+    def _clear(self) -> None:
+        self._samples = (np.empty((0, 0), dtype=np.uint16), np.empty(0, dtype=np.int32), np.empty(0))
+        # Row storage behind _samples; it grows by doubling so appends are amortized O(new rows)
+        self._buffers: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        # Optional per-sample source names (e.g. the file a sample was computed from);
+        # None once any sample was added without one
+        self.sources: Optional[List[str]] = []
+        # Sparse copies of the rows, one (counts, indices, values) part per append, kept
+        # so save() doesn't have to scan the dense matrix
+        self._sparse_parts: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+    # (hists, labels, row sums) are replaced together as one tuple, so a predict running
+    # on another thread never pairs new histograms with old labels
+    @property
+    def hists(self) -> np.ndarray:
+        return self._samples[0]
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._samples[1]
+
+    @property
+    def sums(self) -> np.ndarray:
+        return self._samples[2]
+
+    @property
+    def size(self) -> int:
+        return int(self.labels.size)
+
+    def copy(self) -> "LBPHModel":
+        """A model with the same samples that can be extended without affecting this one.
+        The sample arrays are shared until the copy's first append reallocates them.
+        """
+        other = copy.copy(self)
+        other._buffers = None
+        other.sources = list(self.sources) if self.sources is not None else None
+        other._sparse_parts = list(self._sparse_parts)
+        return other
+
+    def histogram(self, face: np.ndarray) -> np.ndarray:
+        return lbp_histogram(face, self.radius, self.neighbors, self.grid_x, self.grid_y, normed=False)
+
+    def add_histograms(self, hists: np.ndarray, labels: np.ndarray, sources: Optional[List[str]] = None) -> None:
+        """Append count histograms (one row per sample) with their labels and, optionally,
+        their source names.
+        """
+        hists = np.asarray(hists, dtype=np.uint16)
+        self._append(hists, labels, sources, _to_sparse(hists))
+
+    def _append(
+        self,
+        hists: np.ndarray,
+        labels: np.ndarray,
+        sources: Optional[List[str]],
+        sparse: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    ) -> None:
+        labels = np.asarray(labels, dtype=np.int32).ravel()
+        self._sparse_parts.append(sparse)
+        if self.sources is not None:
+            if sources is None or len(sources) != labels.size:
+                self.sources = None
+            else:
+                self.sources.extend(sources)
+        n, need = self.size, self.size + labels.size
+        bufs = self._buffers
+        if bufs is None or need > bufs[1].size:
+            capacity = max(need, 2 * bufs[1].size if bufs is not None else 0)
+            new_bufs = (
+                np.empty((capacity, hists.shape[1]), dtype=np.uint16),
+                np.empty(capacity, dtype=np.int32),
+                np.empty(capacity, dtype=np.float64),
+            )
+            if n:
+                for new, old in zip(new_bufs, self._samples):
+                    new[:n] = old
+            bufs = self._buffers = new_bufs
+        # Rows past `n` are not visible through the current views, so filling them
+        # doesn't disturb a concurrent predict
+        bufs[0][n:need] = hists
+        bufs[1][n:need] = labels
+        hists.sum(axis=1, dtype=np.float64, out=bufs[2][n:need])
+        self._samples = (bufs[0][:need], bufs[1][:need], bufs[2][:need])
+
+    def update(
+        self, faces: List[np.ndarray], labels, map_func: Callable = map, sources: Optional[List[str]] = None
+    ) -> None:
+        """Add samples, like LBPHFaceRecognizer.update. `map_func` may be an executor's
+        map to compute the histograms in parallel.
+        """
+        if not len(faces):
+            return
+        self.add_histograms(np.vstack(list(map_func(self.histogram, faces))), labels, sources)
+
+    def train(
+        self, faces: List[np.ndarray], labels, map_func: Callable = map, sources: Optional[List[str]] = None
+    ) -> None:
+        """Replace all samples, like LBPHFaceRecognizer.train."""
+        self._clear()
+        self.update(faces, labels, map_func, sources)
+
+    def predict(self, face: np.ndarray) -> Tuple[int, float]:
+        """(label, distance) of the nearest sample."""
+        hists, labels, sums = self._samples
+        dists = chi_square(hists, self.histogram(face), sums)
+        idx = int(np.argmin(dists))
+        return int(labels[idx]), float(dists[idx]) / self.cell_area
+
+    def class_spread(self, label: int) -> np.ndarray:
+        """Distance of each sample of `label` to that label's mean histogram."""
+        hists, labels, sums = self._samples
+        mask = labels == label
+        class_hists = hists[mask]
+        return chi_square(class_hists, class_hists.mean(axis=0), sums[mask]) / self.cell_area
+
+    def save(self, path: str) -> None:
+        # Histograms are ~5% non-zero: stored sparsely (CSR: per-row offsets into column
+        # indices and counts) and uncompressed, since saves run on every upload
+        hists, labels, _ = self._samples
+        if len(self._sparse_parts) != 1:
+            # Merge the per-append parts once, so later saves just write them out
+            parts = self._sparse_parts or [_to_sparse(hists)]
+            self._sparse_parts = [tuple(np.concatenate([p[i] for p in parts]) for i in range(3))]
+        counts, indices, values = self._sparse_parts[0]
+        indptr = np.zeros(labels.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        extra = {} if self.sources is None else {"sources": np.array(self.sources, dtype=np.str_)}
+        # Through a temp file and os.replace so readers never see a partial model
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                params=np.array([self.radius, self.neighbors, self.grid_x, self.grid_y, *self.face_size]),
+                shape=np.array(hists.shape, dtype=np.int64),
+                indptr=indptr,
+                indices=indices,
+                values=values,
+                labels=labels,
+                **extra,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LBPHModel":
+        with np.load(path) as data:
+            radius, neighbors, grid_x, grid_y, width, height = (int(v) for v in data["params"])
+            model = cls(radius, neighbors, grid_x, grid_y, (width, height))
+            if data["labels"].size:
+                # Models saved without source names load with sources=None
+                sources = data["sources"].tolist() if "sources" in data.files else None
+                if "hists" in data.files:
+                    # Dense histograms, as saved before the sparse layout
+                    model.add_histograms(data["hists"], data["labels"], sources)
+                else:
+                    hists = np.zeros(tuple(data["shape"]), dtype=np.uint16)
+                    counts, indices, values = np.diff(data["indptr"]), data["indices"], data["values"]
+                    hists[np.repeat(np.arange(hists.shape[0]), counts), indices] = values
+                    model._append(hists, data["labels"], sources, (counts, indices, values))
+        return model
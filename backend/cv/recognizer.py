@@ -1,111 +1,338 @@
-import json
+import asyncio
+import functools
 import os
-import re
 import shutil
 import stat
-from typing import Dict, List, Optional, Tuple, Any
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple, Any
 
 import cv2
 import numpy as np
 
-from .detector import detect_faces
-from .io_utils import ensure_dir, to_grayscale, crop_to_bbox, resize_image
+from .detector import DEFAULT_DETECTOR, detect_faces, set_detector
+from .io_utils import (
+    ensure_dir, to_grayscale, crop_to_bbox, resize_image, decode_image, file_buffer, read_json, write_json_atomic,
+    save_array_atomic,
+)
+from .lbph_fast import LBPHModel
 
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 DATASET_DIR = os.path.join(DATA_DIR, "dataset")
 MODEL_DIR = os.path.join(DATA_DIR, "model")
-MODEL_PATH = os.path.join(MODEL_DIR, "lbph_model.xml")
+# Deleted label folders are moved here, outside the dataset, before being removed
+TRASH_DIR = os.path.join(DATA_DIR, "trash")
+MODEL_PATH = os.path.join(MODEL_DIR, "lbph_model.npz")
+# OpenCV LBPHFaceRecognizer model written by earlier versions; migrated on first load
+LEGACY_MODEL_PATH = os.path.join(MODEL_DIR, "lbph_model.xml")
 LABELS_PATH = os.path.join(DATA_DIR, "labels.json")
 METADATA_PATH = os.path.join(DATA_DIR, "metadata.json")
 THRESHOLDS_PATH = os.path.join(DATA_DIR, "thresholds.json")
 SETTINGS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "settings.json")
 
+# Training samples are named image_0000.npy, image_0001.npy, ... and hold the prepared
+# (trainable) face. Older datasets have image_XXXX.jpg files; those get a .npy sidecar
+# the first time a rebuild prepares them, so later rebuilds skip decode and detection
+_IMG_NAME_PREFIX = "image_"
+_IMG_NAME_SUFFIX = ".jpg"
+_FACE_CACHE_SUFFIX = ".npy"
 
+# Crop padding used for training faces and the paddings tried at prediction time
+_TRAIN_PAD = 0.1
+_VARIANT_PADS = (0.08, 0.12, 0.16)
+# Mean absolute pixel difference below which two variants count as the same image
+_VARIANT_SAME_MAD = 2.0
+
+# LBPH parameters; slightly larger radius/neighbors for more discriminative histograms
+_LBPH_RADIUS = 2
+_LBPH_NEIGHBORS = 12
+_LBPH_GRID_X = 8
+_LBPH_GRID_Y = 8
+
+# Every prepared face is resized to this (width, height)
+_FACE_SIZE = (200, 200)
+
+# |img - 0.15 * Laplacian(img, ksize=3)| as one integer 3x3 filter, scaled by 20 so
+# the weights stay integral in CV_16S; convertScaleAbs divides the scale back out
+_SHARPEN_SCALE = 20
+_SHARPEN_KERNEL = np.array([[-6, 0, -6], [0, 44, 0], [-6, 0, -6]], dtype=np.float32)
+
+# Loaded models keyed by (path, mtime_ns), shared by all service instances instead of
+# re-reading the file. Cached models are never modified: uploads extend a copy
+_MODEL_CACHE: Dict[Tuple[str, int], LBPHModel] = {}
+
+# JSON file -> service attribute persisted in it (see FaceRecognizerService.flush)
+_JSON_FILES = {
+    LABELS_PATH: "labels_to_ids",
+    METADATA_PATH: "label_metadata",
+    THRESHOLDS_PATH: "label_thresholds",
+}
+
+# Opt-in OpenCL (T-API) for the full-frame grayscale/equalize pass, e.g. USE_OPENCL=1
+_USE_OPENCL = os.environ.get("USE_OPENCL", "").strip().lower() in ("1", "true", "yes", "on") and cv2.ocl.haveOpenCL()
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Long-lived pool so per-thread CLAHE/cascade objects survive between rebuilds
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="face-prep")
+    return _executor
+
+
+# CLAHE objects keep scratch buffers between apply() calls, so reuse one per thread
+_thread_state = threading.local()
+
+
+def _get_clahe():
+    clahe = getattr(_thread_state, "clahe", None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        _thread_state.clahe = clahe
+    return clahe
+
+
+def _image_index(name: str) -> Optional[int]:
+    # image_0000.npy / .jpg -> 0, anything else -> None
+    stem, ext = os.path.splitext(name.lower())
+    if ext not in (_IMG_NAME_SUFFIX, _FACE_CACHE_SUFFIX) or not stem.startswith(_IMG_NAME_PREFIX):
+        return None
+    digits = stem[len(_IMG_NAME_PREFIX):]
+    if len(digits) != 4 or not (digits.isascii() and digits.isdigit()):
+        return None
+    return int(digits)
+
+
+def _remove_tree(path: str) -> bool:
+    def _on_rm_error(func, p, exc_info):
+        # Try to make file writable then remove again (Windows OneDrive/AV locks)
+        try:
+            os.chmod(p, stat.S_IWRITE)
+        except Exception:
+            pass
+        try:
+            func(p)
+        except Exception:
+            pass
+    try:
+        shutil.rmtree(path, onerror=_on_rm_error)
+    except Exception:
+        pass
+    return not os.path.exists(path)
+
+
+def _empty_trash() -> None:
+    # Also sweeps folders left behind if an earlier background delete was interrupted
+    if not os.path.isdir(TRASH_DIR):
+        return
+    for name in os.listdir(TRASH_DIR):
+        _remove_tree(os.path.join(TRASH_DIR, name))
+
+
+@functools.lru_cache(maxsize=1)
 def _load_settings() -> Dict:
+    # Read once per process; callers get a copy so the cached dict is never mutated
     # Default settings
     settings = {"confidence_threshold": 60}
     if os.path.exists(SETTINGS_PATH):
         try:
-            with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
-                loaded = json.load(f)
-                settings.update(loaded or {})
+            settings.update(read_json(SETTINGS_PATH) or {})
         except Exception:
             pass
     return settings
 
 
+class ModelNotReadyError(RuntimeError):
+    """The trained model is still being loaded in the background."""
+
+
 class FaceRecognizerService:
     def __init__(self) -> None:
         ensure_dir(DATASET_DIR)
         ensure_dir(MODEL_DIR)
         if not os.path.exists(LABELS_PATH):
-            with open(LABELS_PATH, "w", encoding="utf-8") as f:
-                json.dump({}, f)
+            write_json_atomic(LABELS_PATH, {})
         if not os.path.exists(METADATA_PATH):
-            with open(METADATA_PATH, "w", encoding="utf-8") as f:
-                json.dump({}, f)
-
-        self.settings = _load_settings()
-        self.recognizer = self._create_lbph()
-        self.labels_to_ids: Dict[str, int] = self._load_labels()
-        self.ids_to_labels: Dict[int, str] = {v: k for k, v in self.labels_to_ids.items()}
-        self.label_metadata: Dict[str, Dict[str, Any]] = self._load_metadata()
-        self.label_thresholds: Dict[str, float] = self._load_thresholds()
+            write_json_atomic(METADATA_PATH, {})
+
+        self.settings = dict(_load_settings())
+        self._confidence_threshold = float(self.settings.get("confidence_threshold", 60))
+        # "detector": "lbp" in settings.json selects the faster LBP cascade
+        set_detector(str(self.settings.get("detector", DEFAULT_DETECTOR)).lower())
+        if _USE_OPENCL:
+            cv2.ocl.setUseOpenCL(True)
+        # JSON files changed in memory but not yet written; see flush()
+        self._dirty: Set[str] = set()
+        # (directory mtimes, summary) from the last get_labels_with_counts scan
+        self._labels_cache: Tuple[Tuple, Dict[str, int]] = ((), {})
+        # Whether self.model was loaded or trained; kept by _load_model, _write_model
+        # and _remove_model so predict needn't stat the model file per frame
+        self._model_loaded = False
+        # Cleared while load_model_in_background runs; set otherwise
+        self._model_ready = threading.Event()
+        self._model_ready.set()
+
+    def load_model_in_background(self) -> None:
+        """Read the trained model on a daemon thread so startup doesn't wait for it.
+        Until it is loaded, predict_from_bgr_image raises ModelNotReadyError and the
+        training paths wait for it (async callers through wait_for_model).
+        """
+        self._model_ready.clear()
+        threading.Thread(target=self._warm_model, name="model-load", daemon=True).start()
 
-        if os.path.exists(MODEL_PATH):
-            try:
-                self.recognizer.read(MODEL_PATH)
-            except Exception:
-                # If model is corrupted, ignore
-                pass
+    async def wait_for_model(self) -> None:
+        """Wait for a background model load without blocking the event loop, so health
+        checks and 503s keep being served meanwhile.
+        """
+        if not self._model_ready.is_set():
+            await asyncio.to_thread(self._model_ready.wait)
 
-    def _create_lbph(self):
+    def _warm_model(self) -> None:
+        try:
+            self.model
+        except Exception:
+            # Left unloaded; the first real use raises the error again
+            pass
+        finally:
+            self._model_ready.set()
+
+    # Model, label maps, metadata and thresholds are read on first use; assigning to
+    # one of these attributes replaces the cached value
+    @functools.cached_property
+    def model(self) -> LBPHModel:
+        return self._load_model()
+
+    @functools.cached_property
+    def labels_to_ids(self) -> Dict[str, int]:
+        return self._load_labels()
+
+    @functools.cached_property
+    def ids_to_labels(self) -> Dict[int, str]:
+        return {v: k for k, v in self.labels_to_ids.items()}
+
+    @functools.cached_property
+    def label_metadata(self) -> Dict[str, Dict[str, Any]]:
+        return self._load_metadata()
+
+    @functools.cached_property
+    def label_thresholds(self) -> Dict[str, float]:
+        return self._load_thresholds()
+
+    @staticmethod
+    def _new_model() -> LBPHModel:
+        return LBPHModel(_LBPH_RADIUS, _LBPH_NEIGHBORS, _LBPH_GRID_X, _LBPH_GRID_Y, _FACE_SIZE)
+
+    def _load_legacy_model(self) -> LBPHModel:
+        # Models trained before the NumPy LBPH were saved by OpenCV's LBPHFaceRecognizer;
+        # its normalized float32 histograms convert back to exact per-cell counts
         if not hasattr(cv2, "face"):
             raise RuntimeError("OpenCV contrib modules not available. Install opencv-contrib-python.")
-        # Slightly larger radius/neighbors for more discriminative histograms
-        return cv2.face.LBPHFaceRecognizer_create(radius=2, neighbors=12, grid_x=8, grid_y=8)
+        recognizer = cv2.face.LBPHFaceRecognizer_create(
+            radius=_LBPH_RADIUS, neighbors=_LBPH_NEIGHBORS, grid_x=_LBPH_GRID_X, grid_y=_LBPH_GRID_Y
+        )
+        recognizer.read(LEGACY_MODEL_PATH)
+        model = self._new_model()
+        hists = recognizer.getHistograms()
+        if hists:
+            counts = np.empty((len(hists), hists[0].size), dtype=np.uint16)
+            for row, hist in zip(counts, hists):
+                np.rint(hist.ravel() * model.cell_area, out=row, casting="unsafe")
+            model.add_histograms(counts, recognizer.getLabels())
+        return model
+
+    def _load_model(self) -> LBPHModel:
+        path = MODEL_PATH if os.path.exists(MODEL_PATH) else LEGACY_MODEL_PATH
+        try:
+            key = (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return self._new_model()
+        cached = _MODEL_CACHE.get(key)
+        if cached is not None:
+            self._model_loaded = True
+            return cached
+        try:
+            if path == MODEL_PATH:
+                model = LBPHModel.load(MODEL_PATH)
+            else:
+                model = self._load_legacy_model()
+        except Exception:
+            # If model is corrupted, ignore
+            return self._new_model()
+        if path == LEGACY_MODEL_PATH:
+            # One-time migration; the XML is left in place but no longer read
+            try:
+                model.save(MODEL_PATH)
+                key = (MODEL_PATH, os.stat(MODEL_PATH).st_mtime_ns)
+            except OSError:
+                pass
+        _MODEL_CACHE.clear()
+        _MODEL_CACHE[key] = model
+        self._model_loaded = True
+        return model
+
+    def _write_model(self) -> None:
+        self.model.save(MODEL_PATH)
+        # Register the freshly written file so later instances reuse this model
+        _MODEL_CACHE.clear()
+        _MODEL_CACHE[(MODEL_PATH, os.stat(MODEL_PATH).st_mtime_ns)] = self.model
+        self._model_loaded = True
+
+    def _remove_model(self) -> None:
+        for path in (MODEL_PATH, LEGACY_MODEL_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+        self.model = self._new_model()
+        self._model_loaded = False
 
     def _load_labels(self) -> Dict[str, int]:
         try:
-            with open(LABELS_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f) or {}
-                # Coerce to int values
-                return {str(k): int(v) for k, v in data.items()}
+            data = read_json(LABELS_PATH) or {}
+            # Coerce to int values
+            return {str(k): int(v) for k, v in data.items()}
         except Exception:
             return {}
 
-    def _save_labels(self, mapping: Dict[str, int]) -> None:
-        with open(LABELS_PATH, "w", encoding="utf-8") as f:
-            json.dump(mapping, f, indent=2)
+    def _save_labels(self) -> None:
+        self._dirty.add(LABELS_PATH)
 
     def _load_metadata(self) -> Dict[str, Dict[str, Any]]:
         try:
-            with open(METADATA_PATH, "r", encoding="utf-8") as f:
-                raw = json.load(f) or {}
-                # Backward compatibility: if file was a map of label->title string, wrap into metadata
-                if all(isinstance(v, str) for v in raw.values()):
-                    return {k: {"title": v} for k, v in raw.items()}
-                # Ensure dictionary-of-dicts
-                return {str(k): (v if isinstance(v, dict) else {}) for k, v in raw.items()}
+            raw = read_json(METADATA_PATH) or {}
+            # Backward compatibility: if file was a map of label->title string, wrap into metadata
+            if all(isinstance(v, str) for v in raw.values()):
+                return {k: {"title": v} for k, v in raw.items()}
+            # Ensure dictionary-of-dicts
+            return {str(k): (v if isinstance(v, dict) else {}) for k, v in raw.items()}
         except Exception:
             return {}
 
     def _save_metadata(self) -> None:
-        with open(METADATA_PATH, "w", encoding="utf-8") as f:
-            json.dump(self.label_metadata, f, indent=2)
+        self._dirty.add(METADATA_PATH)
 
     def _load_thresholds(self) -> Dict[str, float]:
         try:
-            with open(THRESHOLDS_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f) or {}
-                return {str(k): float(v) for k, v in data.items()}
+            data = read_json(THRESHOLDS_PATH) or {}
+            return {str(k): float(v) for k, v in data.items()}
         except Exception:
             return {}
 
     def _save_thresholds(self) -> None:
-        with open(THRESHOLDS_PATH, "w", encoding="utf-8") as f:
-            json.dump(self.label_thresholds, f, indent=2)
+        self._dirty.add(THRESHOLDS_PATH)
+
+    def flush(self) -> None:
+        """Write every JSON file changed since the last flush, once each.
+
+        The _save_* methods only mark their file, so a request that touches labels,
+        metadata and thresholds several times (upload + metadata + retrain) costs one
+        atomic write per file. Call this once at the end of each mutating request.
+        """
+        while self._dirty:
+            path = self._dirty.pop()
+            write_json_atomic(path, getattr(self, _JSON_FILES[path]))
 
     def set_label_title(self, label: str, title: Optional[str]) -> None:
         # Backward-compat helper: set just a title field
@@ -133,138 +360,179 @@ class FaceRecognizerService:
     def _next_label_id(self) -> int:
         return 0 if not self.labels_to_ids else max(self.labels_to_ids.values()) + 1
 
-    def _prepare_face(self, image_bgr: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int, int, int]]]:
-        gray = to_grayscale(image_bgr)
+    def _detect_largest(self, image: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int, int, int]]]:
+        """Convert to grayscale (unless `image` already is), equalize and detect once.
+        Returns (gray, bbox) of the largest face, or (None, None) when no face is found.
+        """
+        # With OpenCL the full-frame passes run on the device; the gray frame is
+        # downloaded only when a face was found
+        is_gray = image.ndim == 2
+        src = cv2.UMat(image) if _USE_OPENCL else image
+        gray = src if is_gray else to_grayscale(src)
         # Improve detectability with histogram equalization
         try:
             gray = cv2.equalizeHist(gray)
         except Exception:
             pass
-        faces = detect_faces(gray)
+        faces = detect_faces(gray, image.shape[:2])
         if not faces:
             return None, None
-        # Take the largest face
-        faces_sorted = sorted(faces, key=lambda b: b[2] * b[3], reverse=True)
-        x, y, w, h = faces_sorted[0]
-        # Expand bbox by 10% for more context, clamp to image bounds
+        if isinstance(gray, cv2.UMat):
+            gray = gray.get()
+        # Largest face; first on ties
+        return gray, max(faces, key=lambda b: b[2] * b[3])
+
+    def _enhance_crop(
+        self, gray: np.ndarray, bbox: Tuple[int, int, int, int], pad: float
+    ) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+        x, y, w, h = bbox
+        # Expand bbox by `pad` for more context, clamp to image bounds
         ih, iw = gray.shape[:2]
-        pad_x = int(0.1 * w)
-        pad_y = int(0.1 * h)
+        pad_x = int(pad * w)
+        pad_y = int(pad * h)
         x0 = max(0, x - pad_x)
         y0 = max(0, y - pad_y)
         x1 = min(iw, x + w + pad_x)
         y1 = min(ih, y + h + pad_y)
-        bbox = (x0, y0, x1 - x0, y1 - y0)
-        face_gray = crop_to_bbox(gray, bbox)
-        face_resized = resize_image(face_gray, (200, 200))
-        # Local contrast enhancement (CLAHE) + mild denoise + sharpen for LBPH stability
+        padded = (x0, y0, x1 - x0, y1 - y0)
+        face_gray = crop_to_bbox(gray, padded)
+        face_resized = resize_image(face_gray, _FACE_SIZE)
+        # Local contrast enhancement (CLAHE) + mild denoise + sharpen for LBPH stability.
+        # Stored .npy samples already went through this and are trained as is
         try:
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            face_resized = clahe.apply(face_resized)
+            face_resized = _get_clahe().apply(face_resized)
             face_resized = cv2.GaussianBlur(face_resized, (3, 3), 0)
-            lap = cv2.Laplacian(face_resized, cv2.CV_16S, ksize=3)
-            face_resized = cv2.convertScaleAbs(face_resized - 0.15 * lap)
+            sharp = cv2.filter2D(face_resized, cv2.CV_16S, _SHARPEN_KERNEL)
+            face_resized = cv2.convertScaleAbs(sharp, alpha=1.0 / _SHARPEN_SCALE)
         except Exception:
             pass
-        return face_resized, bbox
+        return face_resized, padded
+
+    def _prepare_face(self, image: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int, int, int]]]:
+        # Accepts BGR or single-channel input; training images are decoded as grayscale
+        gray, bbox = self._detect_largest(image)
+        if bbox is None:
+            return None, None
+        return self._enhance_crop(gray, bbox, _TRAIN_PAD)
 
     def _prepare_face_variants(self, image_bgr: np.ndarray) -> List[Tuple[np.ndarray, Tuple[int, int, int, int]]]:
         """Generate several cropped variants around the detected face to reduce sensitivity
-        to small detection errors. Returns list of (face_image, bbox).
+        to small detection errors. Detection runs once; only the crop and enhancement are
+        repeated per padding. Returns list of (face_image, bbox).
         """
-        variants: List[Tuple[np.ndarray, Tuple[int, int, int, int]]] = []
-        gray = to_grayscale(image_bgr)
-        try:
-            gray = cv2.equalizeHist(gray)
-        except Exception:
-            pass
-        faces = detect_faces(gray)
-        if not faces:
-            return variants
-        faces_sorted = sorted(faces, key=lambda b: b[2] * b[3], reverse=True)
-        x, y, w, h = faces_sorted[0]
-        ih, iw = gray.shape[:2]
-        # Different paddings
-        pads = [0.08, 0.12, 0.16]
-        for p in pads:
-            pad_x = int(p * w)
-            pad_y = int(p * h)
-            x0 = max(0, x - pad_x)
-            y0 = max(0, y - pad_y)
-            x1 = min(iw, x + w + pad_x)
-            y1 = min(ih, y + h + pad_y)
-            bbox = (x0, y0, x1 - x0, y1 - y0)
-            face_gray = crop_to_bbox(gray, bbox)
-            face_resized = resize_image(face_gray, (200, 200))
+        gray, bbox = self._detect_largest(image_bgr)
+        if bbox is None:
+            return []
+        return [self._enhance_crop(gray, bbox, p) for p in _VARIANT_PADS]
+
+    def _process_file(self, label_id: int, fpath: str) -> Optional[Tuple[np.ndarray, int]]:
+        stem, ext = os.path.splitext(fpath)
+        if ext == _FACE_CACHE_SUFFIX:
             try:
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-                face_resized = clahe.apply(face_resized)
-                face_resized = cv2.GaussianBlur(face_resized, (3, 3), 0)
-                lap = cv2.Laplacian(face_resized, cv2.CV_16S, ksize=3)
-                face_resized = cv2.convertScaleAbs(face_resized - 0.15 * lap)
+                face = np.load(fpath)
+                if face.dtype == np.uint8 and face.shape == (_FACE_SIZE[1], _FACE_SIZE[0]):
+                    return face, label_id
             except Exception:
                 pass
-            variants.append((face_resized, bbox))
-        return variants
+            # Unreadable cache: regenerate it from the image it was made from
+            fpath = stem + _IMG_NAME_SUFFIX
+            if not os.path.isfile(fpath):
+                return None
+        # LBPH only uses intensity, so skip the color conversion in the JPEG decoder
+        img = cv2.imread(fpath, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            return None
+        face, _ = self._prepare_face(img)
+        if face is None:
+            return None
+        try:
+            save_array_atomic(stem + _FACE_CACHE_SUFFIX, face)
+        except OSError:
+            pass
+        return face, label_id
 
-    def _collect_dataset(self) -> Tuple[List[np.ndarray], List[int]]:
-        images: List[np.ndarray] = []
-        labels: List[int] = []
-        for label in sorted(os.listdir(DATASET_DIR)):
-            label_dir = os.path.join(DATASET_DIR, label)
-            if not os.path.isdir(label_dir):
-                continue
+    def _dataset_files(self) -> List[Tuple[int, str, str]]:
+        """(label id, sample name, path) for every sample in the dataset, where the sample
+        name is "<label>/<stem>". Assigns ids to new label folders.
+        """
+        tasks: List[Tuple[int, str, str]] = []
+        with os.scandir(DATASET_DIR) as it:
+            label_dirs = sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+        for label_entry in label_dirs:
+            label = label_entry.name
             if label not in self.labels_to_ids:
                 self.labels_to_ids[label] = self._next_label_id()
             label_id = self.labels_to_ids[label]
-            for fname in os.listdir(label_dir):
-                fpath = os.path.join(label_dir, fname)
-                if not os.path.isfile(fpath):
-                    continue
-                img = cv2.imread(fpath)
-                if img is None:
-                    continue
-                face, _ = self._prepare_face(img)
-                if face is None:
+            with os.scandir(label_entry.path) as it:
+                files = [e for e in it if e.is_file() and not e.name.endswith(".tmp")]
+            cached = {
+                os.path.splitext(e.name)[0]: e.stat().st_mtime_ns
+                for e in files
+                if e.name.endswith(_FACE_CACHE_SUFFIX)
+            }
+            # Images with an up-to-date cached face are loaded from the .npy; new or
+            # replaced images are prepared and get their sidecar (re)written
+            fresh = set(cached)
+            for entry in files:
+                stem, ext = os.path.splitext(entry.name)
+                if ext != _FACE_CACHE_SUFFIX and stem in cached and cached[stem] < entry.stat().st_mtime_ns:
+                    fresh.discard(stem)
+            for entry in files:
+                stem, ext = os.path.splitext(entry.name)
+                if (ext == _FACE_CACHE_SUFFIX) != (stem in fresh):
                     continue
-                images.append(face)
-                labels.append(label_id)
-        return images, labels
+                tasks.append((label_id, f"{label}/{stem}", entry.path))
+        return tasks
+
+    def _load_faces(self, tasks: List[Tuple[int, str, str]]) -> Tuple[List[np.ndarray], List[int], List[str]]:
+        """Decode and prepare the samples from _dataset_files: (faces, label ids, sample
+        names), leaving out files without a usable face.
+        """
+        images: List[np.ndarray] = []
+        labels: List[int] = []
+        names: List[str] = []
+        # imread, cvtColor and detectMultiScale release the GIL, so threads overlap I/O and CPU
+        args = [(label_id, path) for label_id, _, path in tasks]
+        if len(args) > 1:
+            results = _get_executor().map(self._process_file, *zip(*args))
+        else:
+            results = (self._process_file(*a) for a in args)
+        for (_, name, _), result in zip(tasks, results):
+            if result is None:
+                continue
+            face, label_id = result
+            images.append(face)
+            labels.append(label_id)
+            names.append(name)
+        return images, labels, names
 
     def rebuild_from_dataset(self) -> Tuple[int, int]:
-        images, labels = self._collect_dataset()
+        # A background load finishing later would replace the model trained here.
+        # Endpoints await wait_for_model first, so on the event loop this returns at once
+        self._model_ready.wait()
+        images, labels, names = self._load_faces(self._dataset_files())
         # Save labels map (might have been extended)
-        self._save_labels(self.labels_to_ids)
+        self._save_labels()
         self.ids_to_labels = {v: k for k, v in self.labels_to_ids.items()}
 
         if not images:
             # No data to train
-            if os.path.exists(MODEL_PATH):
-                os.remove(MODEL_PATH)
+            self._remove_model()
             raise RuntimeError("No faces found in dataset to train the model.")
 
-        self.recognizer = self._create_lbph()
-        self.recognizer.train(images, np.array(labels))
-        self.recognizer.write(MODEL_PATH)
+        model = self._new_model()
+        # Recording each sample's file lets uploads work out what isn't trained yet
+        model.train(images, labels, _get_executor().map, names)
+        self.model = model
+        self._write_model()
 
-        # Compute adaptive label thresholds based on training distances
+        # Compute adaptive label thresholds
         try:
-            distances_by_label: Dict[int, List[float]] = {}
-            for img, lid in zip(images, labels):
-                _, dist = self.recognizer.predict(img)
-                distances_by_label.setdefault(int(lid), []).append(float(dist))
             thresholds: Dict[str, float] = {}
-            for lid, dists in distances_by_label.items():
-                if not dists:
-                    continue
-                arr = np.array(dists, dtype=np.float32)
-                mean = float(np.mean(arr))
-                std = float(np.std(arr))
-                # Mean + 2*std, clipped to a sane range
-                th = max(55.0, min(130.0, mean + 2.0 * std))
+            for lid in np.unique(self.model.labels):
                 label = self.ids_to_labels.get(int(lid))
                 if label:
-                    thresholds[label] = float(th)
+                    thresholds[label] = self._label_threshold(int(lid))
             if thresholds:
                 self.label_thresholds = thresholds
                 self._save_thresholds()
@@ -275,38 +543,76 @@ class FaceRecognizerService:
         images_count = len(images)
         return labels_count, images_count
 
+    def _label_threshold(self, label_id: int) -> float:
+        # Spread of each sample's distance to its label's mean histogram
+        arr = self.model.class_spread(label_id)
+        mean = float(np.mean(arr))
+        std = float(np.std(arr))
+        # Mean + 2*std, clipped to a sane range
+        return float(max(55.0, min(130.0, mean + 2.0 * std)))
+
+    def trained_counts(self) -> Tuple[int, int]:
+        # (labels, images) in the current model, as returned by rebuild_from_dataset
+        return int(np.unique(self.model.labels).size), self.model.size
+
+    def _update_labels(self, faces: List[np.ndarray], label_ids: List[int], names: List[str], label: str) -> None:
+        """Append `faces` to the trained model with LBPH's incremental update and
+        refresh the thresholds of `label` and of the labels the faces belong to.
+        """
+        if faces:
+            model = self.model.copy()
+            model.update(faces, np.asarray(label_ids, dtype=np.int32), _get_executor().map, names)
+            self.model = model
+            self._write_model()
+        for lid in sorted(set(label_ids) | {self.labels_to_ids[label]}):
+            name = self.ids_to_labels.get(lid)
+            if name is None or not np.any(self.model.labels == lid):
+                continue
+            try:
+                self.label_thresholds[name] = self._label_threshold(lid)
+                self._save_thresholds()
+            except Exception:
+                # If computing the threshold fails, keep the previous value
+                pass
+
     async def add_training_images_for_label(self, label: str, files) -> Tuple[int, int]:
         """
         Save new images for a label without overwriting existing ones.
-        Continues the numeric sequence like image_0006.jpg → image_0007.jpg …
+        Continues the numeric sequence like image_0006 → image_0007 …
+        Samples the model doesn't have yet are added to it incrementally; without a
+        usable model (none yet, no record of its samples, or samples removed from the
+        dataset), the whole dataset is trained once.
         """
         label_dir = os.path.join(DATASET_DIR, label)
         ensure_dir(label_dir)
         processed = 0
         skipped = 0
+        # Loading the model first migrates a legacy XML model to MODEL_PATH
+        await self.wait_for_model()
+        incremental = self.model.size > 0 and os.path.exists(MODEL_PATH)
 
         # Ensure label has an ID
         if label not in self.labels_to_ids:
             self.labels_to_ids[label] = self._next_label_id()
-            self._save_labels(self.labels_to_ids)
+            self.ids_to_labels[self.labels_to_ids[label]] = label
+            self._save_labels()
 
-        # Find current max index (pattern: image_0000.jpg)
-        pattern = re.compile(r"^image_(\d{4})\.jpg$", re.IGNORECASE)
+        # Find current max index (pattern: image_0000.npy or .jpg)
         max_idx = -1
-        for fname in os.listdir(label_dir):
-            m = pattern.match(fname)
-            if m:
-                try:
-                    max_idx = max(max_idx, int(m.group(1)))
-                except ValueError:
-                    pass
+        with os.scandir(label_dir) as entries:
+            for entry in entries:
+                index = _image_index(entry.name)
+                if index is not None:
+                    max_idx = max(max_idx, index)
         idx = max_idx + 1
 
         for up in files:
             try:
-                data = await up.read()
-                arr = np.frombuffer(data, dtype=np.uint8)
-                img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+                # Decode straight from the upload's spooled storage instead of reading a copy
+                with file_buffer(up.file) as data:
+                    img = decode_image(data, cv2.IMREAD_GRAYSCALE)
+                # Release the spooled temp file now rather than at the end of the request
+                await up.close()
                 if img is None:
                     skipped += 1
                     continue
@@ -314,17 +620,49 @@ class FaceRecognizerService:
                 if face is None:
                     skipped += 1
                     continue
-                # Save normalized face for consistency
-                out_path = os.path.join(label_dir, f"image_{idx:04d}.jpg")
-                cv2.imwrite(out_path, face)
+                # Stored faces are prepared twice, as training expects
+                face, _ = self._prepare_face(face)
+                if face is None:
+                    skipped += 1
+                    continue
+                out_path = os.path.join(label_dir, f"{_IMG_NAME_PREFIX}{idx:04d}{_FACE_CACHE_SUFFIX}")
+                save_array_atomic(out_path, face)
                 processed += 1
                 idx += 1
             except Exception:
                 skipped += 1
+        self._invalidate_labels_cache()
+        known_labels = len(self.labels_to_ids)
+        tasks = self._dataset_files()
+        trained = self.model.sources
+        present = {name for _, name, _ in tasks}
+        if incremental and trained is not None and present.issuperset(trained):
+            # Train only the samples the model doesn't have yet: these uploads, plus
+            # any images copied into label folders by hand
+            trained_names = set(trained)
+            new_faces, new_label_ids, new_names = self._load_faces(
+                [t for t in tasks if t[1] not in trained_names]
+            )
+            if len(self.labels_to_ids) != known_labels:
+                # Folders created by hand were given label ids during the walk
+                self.ids_to_labels = {v: k for k, v in self.labels_to_ids.items()}
+                self._save_labels()
+            self._update_labels(new_faces, new_label_ids, new_names, label)
+        else:
+            # No model to extend (first upload, or it was removed), one that doesn't record
+            # its samples (legacy), or trained files were removed: train from the dataset
+            self.rebuild_from_dataset()
         return processed, skipped
 
     def predict_from_bgr_image(self, image_bgr: np.ndarray) -> Dict:
-        if not os.path.exists(MODEL_PATH):
+        if not self._model_ready.is_set():
+            raise ModelNotReadyError("Model is still loading. Please retry shortly.")
+        # Read once: training endpoints may swap these while this runs on a pool thread.
+        # self.model first, since the lazy load is what sets _model_loaded
+        model = self.model
+        ids_to_labels = self.ids_to_labels
+        label_thresholds = self.label_thresholds
+        if not model.size or not self._model_loaded:
             raise RuntimeError("Model not trained yet. Please upload training images.")
 
         # Try multiple variants and choose the best score (smallest distance)
@@ -346,12 +684,16 @@ class FaceRecognizerService:
             return {"label": "Unknown", "title": None, "confidence": None, "bbox": None}
 
         # Majority vote among labels that are under threshold, with distance margins
-        threshold = float(self.settings.get("confidence_threshold", 60))
+        threshold = self._confidence_threshold
         votes: Dict[int, List[Tuple[float, Tuple[int, int, int, int]]]] = {}
         best_tuple: Optional[Tuple[int, float, Tuple[int, int, int, int]]] = None
+        last_face: Optional[np.ndarray] = None
         for face_img, vbox in filtered:
-            lid, conf = self.recognizer.predict(face_img)
-            conf = float(conf)
+            # Variants that came out (nearly) pixel-identical, e.g. when padding is clamped
+            # at the frame edge, reuse the previous prediction but still cast their vote
+            if last_face is None or cv2.norm(face_img, last_face, cv2.NORM_L1) / face_img.size >= _VARIANT_SAME_MAD:
+                lid, conf = model.predict(face_img)
+                last_face = face_img
             if best_tuple is None or conf < best_tuple[1]:
                 best_tuple = (lid, conf, vbox)
             if conf <= threshold:
@@ -397,10 +739,10 @@ class FaceRecognizerService:
                 return {"label": "Unknown", "title": None, "confidence": float(best_conf), "bbox": list(map(int, best_bbox)) if best_bbox else None}
         # Convert LBPH distance into a 0..1 score (higher is better)
         score = max(0.0, min(1.0, (threshold - float(confidence)) / max(threshold, 1e-6)))
-        if confidence is not None and label_id is not None and label_id in self.ids_to_labels:
-            label = self.ids_to_labels[label_id]
+        if confidence is not None and label_id is not None and label_id in ids_to_labels:
+            label = ids_to_labels[label_id]
             # Allow a per-label adaptive threshold (capped to +10 over global)
-            label_th = float(self.label_thresholds.get(label, threshold))
+            label_th = float(label_thresholds.get(label, threshold))
             effective_th = min(threshold + 10.0, max(threshold, label_th))
             if confidence > effective_th:
                 return {
@@ -425,40 +767,62 @@ class FaceRecognizerService:
             "bbox": list(map(int, bbox)) if bbox else None,
         }
 
+    def _dataset_signature(self) -> Tuple:
+        # Adding or removing a label folder or image changes its parent's mtime, so this
+        # tuple changes with any edit that affects the counts
+        dataset_mtime = os.stat(DATASET_DIR).st_mtime_ns
+        with os.scandir(DATASET_DIR) as entries:
+            folders = sorted(
+                (entry.name, entry.stat(follow_symlinks=False).st_mtime_ns)
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+            )
+        return dataset_mtime, tuple(folders)
+
+    def _invalidate_labels_cache(self) -> None:
+        # Explicit bust for our own writes, which may land within the mtime granularity
+        self._labels_cache = ((), {})
+
     def get_labels_with_counts(self) -> Dict[str, int]:
+        # Polled by the frontend: reuse the last scan while no label folder changed
+        signature = self._dataset_signature()
+        cached_sig, cached = self._labels_cache
+        if signature == cached_sig:
+            return dict(cached)
         summary: Dict[str, int] = {}
-        for label in sorted(os.listdir(DATASET_DIR)):
-            label_dir = os.path.join(DATASET_DIR, label)
-            if not os.path.isdir(label_dir):
-                continue
-            count = len([f for f in os.listdir(label_dir) if os.path.isfile(os.path.join(label_dir, f))])
-            summary[label] = count
-        return summary
+        for name, _ in signature[1]:
+            with os.scandir(os.path.join(DATASET_DIR, name)) as files:
+                # An image and its cached face share a stem and count once; half-written
+                # .tmp files are not samples
+                summary[name] = len({
+                    os.path.splitext(f.name)[0]
+                    for f in files
+                    if f.is_file(follow_symlinks=False) and not f.name.endswith(".tmp")
+                })
+        self._labels_cache = (signature, summary)
+        return dict(summary)
 
     def delete_label_and_retrain(self, label: str) -> Dict:
         label_dir = os.path.join(DATASET_DIR, label)
         removed = False
         if os.path.isdir(label_dir):
-            def _on_rm_error(func, path, exc_info):
-                # Try to make file writable then remove again (Windows OneDrive/AV locks)
-                try:
-                    os.chmod(path, stat.S_IWRITE)
-                except Exception:
-                    pass
-                try:
-                    func(path)
-                except Exception:
-                    pass
+            # Move the folder out of the dataset with one rename and delete the files in
+            # the background, so the request does not wait on a per-file unlink loop
             try:
-                shutil.rmtree(label_dir, onerror=_on_rm_error)
-                removed = not os.path.exists(label_dir)
-            except Exception:
-                removed = False
+                ensure_dir(TRASH_DIR)
+                os.rename(label_dir, os.path.join(TRASH_DIR, uuid.uuid4().hex))
+                removed = True
+            except OSError:
+                # Rename can fail on locked folders; fall back to deleting in place
+                removed = _remove_tree(label_dir)
+            if removed:
+                threading.Thread(target=_empty_trash, daemon=True).start()
+            self._invalidate_labels_cache()
 
         # Remove from labels map
         if label in self.labels_to_ids:
             del self.labels_to_ids[label]
-            self._save_labels(self.labels_to_ids)
+            self._save_labels()
             self.ids_to_labels = {v: k for k, v in self.labels_to_ids.items()}
             # Also remove metadata
             if label in self.label_metadata:
@@ -468,12 +832,13 @@ class FaceRecognizerService:
         # Retrain if any data remains
         labels_count = 0
         images_count = 0
-        if any(os.path.isdir(os.path.join(DATASET_DIR, d)) for d in os.listdir(DATASET_DIR)):
+        with os.scandir(DATASET_DIR) as it:
+            has_labels = any(e.is_dir() for e in it)
+        if has_labels:
             try:
                 labels_count, images_count = self.rebuild_from_dataset()
             except RuntimeError:
-                # No images/faces remain
-                if os.path.exists(MODEL_PATH):
-                    os.remove(MODEL_PATH)
+                # No images/faces remain (the rebuild already dropped the model)
+                pass
 
         return {"removed": removed, "labels_count": labels_count, "images_count": images_count}
@@ -1,14 +1,46 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from contextlib import asynccontextmanager
 from typing import List, Optional
 import uvicorn
 
-from cv.io_utils import decode_data_url_to_image
-from cv.recognizer import FaceRecognizerService
+from cv.inference_pool import InferencePool, InferencePoolBusyError
+from cv.io_utils import decode_image
+from cv.recognizer import FaceRecognizerService, ModelNotReadyError
 
 
-app = FastAPI(title="Criminal Face Recognition API", version="0.1.0")
+recognizer_service = FaceRecognizerService()
+
+
+def _infer_frame(image_data_url: str):
+    # Runs on the inference pool's worker threads
+    image_bgr = decode_image(image_data_url)
+    if image_bgr is None:
+        raise HTTPException(status_code=400, detail="Invalid image payload")
+
+    try:
+        return recognizer_service.predict_from_bgr_image(image_bgr)
+    except ModelNotReadyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except RuntimeError as e:
+        # Model not trained yet
+        return JSONResponse({"label": "Unknown", "confidence": None, "bbox": None, "error": str(e)}, status_code=200)
+
+
+# Concurrent /api/infer calls (several webcams polling) run in parallel on a thread pool
+infer_pool = InferencePool(_infer_frame)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve /api/health right away; /api/infer answers 503 until the model is read
+    recognizer_service.load_model_in_background()
+    yield
+    await infer_pool.stop()
+
+
+app = FastAPI(title="Criminal Face Recognition API", version="0.1.0", lifespan=lifespan)
 
 origins = ["*"]
 
@@ -21,9 +53,6 @@ app.add_middleware(
 )
 
 
-recognizer_service = FaceRecognizerService()
-
-
 @app.get("/api/health")
 async def health():
     return {"status": "ok"}
@@ -44,20 +73,16 @@ async def get_label_metadata(label: str):
 
 
 @app.post("/api/infer")
-async def infer(body: dict):
+async def infer(body: dict, request: Request):
     if "image" not in body:
         raise HTTPException(status_code=400, detail="Missing 'image' data URL")
-    image_data_url = body["image"]
-    image_bgr = decode_data_url_to_image(image_data_url)
-    if image_bgr is None:
-        raise HTTPException(status_code=400, detail="Invalid image payload")
-
     try:
-        result = recognizer_service.predict_from_bgr_image(image_bgr)
-    except RuntimeError as e:
-        # Model not trained yet
-        return JSONResponse({"label": "Unknown", "confidence": None, "bbox": None, "error": str(e)}, status_code=200)
-
+        result = await infer_pool.submit(body["image"], request.is_disconnected)
+    except InferencePoolBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    if result is None:
+        # Client disconnected while waiting; nothing was computed and nobody reads this
+        return Response(status_code=499)
     return result
 
 
@@ -75,29 +100,38 @@ async def train_upload(
 ):
     if not label or not label.strip():
         raise HTTPException(status_code=400, detail="Label is required")
+    await recognizer_service.wait_for_model()
 
-    processed, skipped = await recognizer_service.add_training_images_for_label(label.strip(), files)
-    # Store structured metadata (all optional)
-    recognizer_service.set_label_metadata(
-        label.strip(),
-        {
-            "title": (title.strip() if isinstance(title, str) else title),
-            "case": (case.strip() if isinstance(case, str) else case),
-            # Prefer 'sex' if provided, else fallback to legacy 'gender'
-            "sex": (sex.strip() if isinstance(sex, str) else (gender.strip() if isinstance(gender, str) else (sex or gender))),
-            "age": (age.strip() if isinstance(age, str) else age),
-            "address": (address.strip() if isinstance(address, str) else address),
-            "notes": (notes.strip() if isinstance(notes, str) else notes),
-        },
-    )
-    # Retrain after adding
-    labels_count, images_count = recognizer_service.rebuild_from_dataset()
+    try:
+        processed, skipped = await recognizer_service.add_training_images_for_label(label.strip(), files)
+        # Store structured metadata (all optional)
+        recognizer_service.set_label_metadata(
+            label.strip(),
+            {
+                "title": (title.strip() if isinstance(title, str) else title),
+                "case": (case.strip() if isinstance(case, str) else case),
+                # Prefer 'sex' if provided, else fallback to legacy 'gender'
+                "sex": (sex.strip() if isinstance(sex, str) else (gender.strip() if isinstance(gender, str) else (sex or gender))),
+                "age": (age.strip() if isinstance(age, str) else age),
+                "address": (address.strip() if isinstance(address, str) else address),
+                "notes": (notes.strip() if isinstance(notes, str) else notes),
+            },
+        )
+    finally:
+        # Labels, metadata and thresholds changed above are written once here
+        recognizer_service.flush()
+    # The upload already extended the model; just report its size
+    labels_count, images_count = recognizer_service.trained_counts()
     return {"added": processed, "skipped": skipped, "labels_count": labels_count, "images_count": images_count}
 
 
 @app.post("/api/train/rebuild")
 async def train_rebuild():
-    labels_count, images_count = recognizer_service.rebuild_from_dataset()
+    await recognizer_service.wait_for_model()
+    try:
+        labels_count, images_count = recognizer_service.rebuild_from_dataset()
+    finally:
+        recognizer_service.flush()
     return {"labels_count": labels_count, "images_count": images_count}
 
 
@@ -105,7 +139,11 @@ async def train_rebuild():
 async def train_delete(label: str):
     if not label:
         raise HTTPException(status_code=400, detail="Label query parameter is required")
-    summary = recognizer_service.delete_label_and_retrain(label)
+    await recognizer_service.wait_for_model()
+    try:
+        summary = recognizer_service.delete_label_and_retrain(label)
+    finally:
+        recognizer_service.flush()
     return summary
 
 